@@ -1,12 +1,14 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 import util
 
-def define_tsnet(name, num_class, cuda=True):
+def define_tsnet(name, num_class, cuda=True, grad_checkpoint=False):
 	if name == 'resnet20':
-		net = resnet20(num_class=num_class)
+		net = resnet20(num_class=num_class, grad_checkpoint=grad_checkpoint)
 	elif name == 'resnet110':
-		net = resnet110(num_class=num_class)
+		net = resnet110(num_class=num_class, grad_checkpoint=grad_checkpoint)
 	else:
 		raise Exception('model name does not exist.')
 
@@ -15,6 +17,31 @@ def define_tsnet(name, num_class, cuda=True):
 	util.print_network(net)
 	return net
 
+def fuse_tsnet_bn(net):
+	# fold every BatchNorm of a frozen, eval-mode net into the conv in front of it
+	for m in list(net.modules()):
+		if isinstance(m, nn.Sequential) and len(m) == 2 and \
+		   isinstance(m[0], nn.Conv2d) and isinstance(m[1], nn.BatchNorm2d):
+			pairs = [('0', '1')]
+		else:
+			pairs = [('conv1', 'bn1'), ('conv2', 'bn2')]
+		for conv_name, bn_name in pairs:
+			conv = getattr(m, conv_name, None)
+			bn   = getattr(m, bn_name, None)
+			if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+				setattr(m, conv_name, fuse_conv_bn_eval(conv, bn))
+				setattr(m, bn_name, nn.Identity())
+	return net
+
+def compensate_bn_recompute(*stages):
+	# a checkpointed stage is run again in backward on the same input, so its BatchNorms
+	# update their running stats twice per step. Two updates with momentum 1-sqrt(1-m)
+	# equal a single update with momentum m, which keeps the eval statistics unchanged.
+	for stage in stages:
+		for m in stage.modules():
+			if isinstance(m, nn.BatchNorm2d) and m.momentum is not None:
+				m.momentum = 1.0 - (1.0 - m.momentum) ** 0.5
+
 class resblock(nn.Module):
 	def __init__(self, in_channels, out_channels):
 		super(resblock, self).__init__()
@@ -52,8 +79,9 @@ class resblock(nn.Module):
 		return out
 
 class resnet20(nn.Module):
-	def __init__(self, num_class):
+	def __init__(self, num_class, grad_checkpoint=False):
 		super(resnet20, self).__init__()
+		self.grad_checkpoint = grad_checkpoint
 		self.conv1   = nn.Conv2d(3, 16, kernel_size=3, stride=1, padding=1, bias=False)
 		self.bn1     = nn.BatchNorm2d(16)
 		self.relu    = nn.ReLU(inplace=True)
@@ -72,30 +100,42 @@ class resnet20(nn.Module):
 				nn.init.constant_(m.weight, 1)
 				nn.init.constant_(m.bias, 0)
 
+		if grad_checkpoint:
+			compensate_bn_recompute(self.res1, self.res2, self.res3)
+
 	def make_layer(self, block, num, in_channels, out_channels):
 		layers = [block(in_channels, out_channels)]
 		for i in range(num-1):
 			layers.append(block(out_channels, out_channels))
 		return nn.Sequential(*layers)
 
-	def forward(self, x):
+	def forward(self, x, return_features=True):
 		pre = self.conv1(x)
 		pre = self.bn1(pre)
 		pre = self.relu(pre)
 
-		rb1 = self.res1(pre)
-		rb2 = self.res2(rb1)
-		rb3 = self.res3(rb2)
+		if self.grad_checkpoint and self.training:
+			# only the stage inputs are kept, the stages are recomputed in backward
+			rb1 = checkpoint(self.res1, pre, use_reentrant=False)
+			rb2 = checkpoint(self.res2, rb1, use_reentrant=False)
+			rb3 = checkpoint(self.res3, rb2, use_reentrant=False)
+		else:
+			rb1 = self.res1(pre)
+			rb2 = self.res2(rb1)
+			rb3 = self.res3(rb2)
 
 		out = self.avgpool(rb3)
 		out = out.view(out.size(0), -1)
 		out = self.fc(out)
 
+		if not return_features:
+			return out
 		return pre, rb1, rb2, rb3, out
 
 class resnet110(nn.Module):
-	def __init__(self, num_class):
+	def __init__(self, num_class, grad_checkpoint=False):
 		super(resnet110, self).__init__()
+		self.grad_checkpoint = grad_checkpoint
 		self.conv1   = nn.Conv2d(3, 16, kernel_size=3, stride=1, padding=1, bias=False)
 		self.bn1     = nn.BatchNorm2d(16)
 		self.relu    = nn.ReLU(inplace=True)
@@ -114,25 +154,36 @@ class resnet110(nn.Module):
 				nn.init.constant_(m.weight, 1)
 				nn.init.constant_(m.bias, 0)
 
+		if grad_checkpoint:
+			compensate_bn_recompute(self.res1, self.res2, self.res3)
+
 	def make_layer(self, block, num, in_channels, out_channels):
 		layers = [block(in_channels, out_channels)]
 		for i in range(num-1):
 			layers.append(block(out_channels, out_channels))
 		return nn.Sequential(*layers)
 
-	def forward(self, x):
+	def forward(self, x, return_features=True):
 		pre = self.conv1(x)
 		pre = self.bn1(pre)
 		pre = self.relu(pre)
 
-		rb1 = self.res1(pre)
-		rb2 = self.res2(rb1)
-		rb3 = self.res3(rb2)
+		if self.grad_checkpoint and self.training:
+			# only the stage inputs are kept, the stages are recomputed in backward
+			rb1 = checkpoint(self.res1, pre, use_reentrant=False)
+			rb2 = checkpoint(self.res2, rb1, use_reentrant=False)
+			rb3 = checkpoint(self.res3, rb2, use_reentrant=False)
+		else:
+			rb1 = self.res1(pre)
+			rb2 = self.res2(rb1)
+			rb3 = self.res3(rb2)
 
 		out = self.avgpool(rb3)
 		out = out.view(out.size(0), -1)
 		out = self.fc(out)
 
+		if not return_features:
+			return out
 		return pre, rb1, rb2, rb3, out
 
 
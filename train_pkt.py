@@ -3,16 +3,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
+import torchvision.transforms.v2 as transforms
 import torchvision.datasets as dst
 
 import argparse
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from util import AverageMeter, accuracy, transform_time
-from util import load_pretrained_model, save_checkpoint
-from network import define_tsnet
+from util import AverageMeter, accuracy, transform_time, GPUCifarLoader, Normalizer, IndexedDataset, fast_collate
+from util import load_pretrained_model, save_checkpoint_async
+from network import define_tsnet, fuse_tsnet_bn
 
 parser = argparse.ArgumentParser(description='Probabilistic Knowledge Transfer')
 
@@ -31,6 +32,13 @@ parser.add_argument('--momentum', type=float, default=0.9, help='momentum')
 parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight decay')
 parser.add_argument('--num_class', type=int, default=10, help='number of classes')
 parser.add_argument('--cuda', type=int, default=1)
+parser.add_argument('--gpu_loader', type=int, default=1, help='keep the training set on the gpu and augment it there')
+parser.add_argument('--cuda_graph', type=int, default=0, help='replay the train step as a cuda graph, '
+					'single gpu only, the last partial batch runs eagerly')
+parser.add_argument('--grad_checkpoint', type=int, default=0, help='recompute the student residual stages in backward, '
+					'trades compute for memory to allow a larger batch_size')
+parser.add_argument('--cache_teacher', type=int, default=0, help='reuse the first epoch teacher outputs per training sample, '
+					'an approximation since the augmentation changes every epoch')
 
 # net and dataset choosen
 parser.add_argument('--data_name', type=str, required=True, help='name of dataset')# cifar10/cifar100
@@ -50,9 +58,17 @@ def main():
 
 	if args.cuda:
 		cudnn.benchmark = True
+		torch.backends.cuda.matmul.allow_tf32 = True
+		cudnn.allow_tf32 = True
+
+	# DataParallel runs replicas on several threads, which cannot be captured in a cuda graph
+	if args.cuda and args.cuda_graph and torch.cuda.device_count() != 1:
+		raise Exception('--cuda_graph needs exactly one visible gpu, found {}, '
+						'restrict them with CUDA_VISIBLE_DEVICES'.format(torch.cuda.device_count()))
 
 	print('----------- Network Initialization --------------')
-	snet = define_tsnet(name=args.s_name, num_class=args.num_class, cuda=args.cuda)
+	snet = define_tsnet(name=args.s_name, num_class=args.num_class, cuda=args.cuda,
+						grad_checkpoint=bool(args.grad_checkpoint))
 	checkpoint = torch.load(args.s_init)
 	load_pretrained_model(snet, checkpoint['net'])
 
@@ -60,16 +76,32 @@ def main():
 	checkpoint = torch.load(args.t_model)
 	load_pretrained_model(tnet, checkpoint['net'])
 	tnet.eval()
+	# the teacher is frozen, so its BatchNorms can be folded into the convolutions
+	tnet = fuse_tsnet_bn(tnet)
 	for param in tnet.parameters():
 		param.requires_grad = False
+
+	# NHWC layout enables the faster cudnn tensor-core convolutions
+	if args.cuda:
+		snet = snet.to(memory_format=torch.channels_last)
+		tnet = tnet.to(memory_format=torch.channels_last)
 	print('-----------------------------------------------')
 
+	# side stream for the frozen teacher, so that its forward overlaps with the student's
+	# (not needed when the whole step is replayed as a cuda graph)
+	if args.cuda and not args.cuda_graph:
+		tstream = torch.cuda.Stream()
+	else:
+		tstream = None
+
 	# initialize optimizer
 	optimizer = torch.optim.SGD(snet.parameters(),
 								lr = args.lr, 
 								momentum = args.momentum, 
 								weight_decay = args.weight_decay,
-								nesterov = True)
+								nesterov = True,
+								fused = bool(args.cuda))
+	scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[100, 150], gamma=0.1)
 
 	# define loss functions
 	if args.cuda:
@@ -89,42 +121,65 @@ def main():
 	else:
 		raise Exception('invalid dataset name...')
 
+	# v2 transforms augment the uint8 tensor instead of the PIL image
 	train_transform = transforms.Compose([
+			transforms.PILToTensor(),
 			transforms.Pad(4, padding_mode='reflect'),
 			transforms.RandomCrop(32),
-			transforms.RandomHorizontalFlip(),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean,std=std)
+			transforms.RandomHorizontalFlip()
 		])
 	test_transform = transforms.Compose([
-			transforms.CenterCrop(32),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean,std=std)
+			transforms.PILToTensor(),
+			transforms.CenterCrop(32)
 		])
 
+	# images stay uint8 in the loaders, they are normalized batch-wise on the gpu
+	normalizer = Normalizer(mean=mean, std=std)
+	if args.cuda:
+		normalizer = normalizer.cuda()
+
 	# define data loader
-	train_loader = torch.utils.data.DataLoader(
-			dataset(root      = args.img_root,
-					transform = train_transform,
-					train     = True,
-					download  = True),
-			batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
+	train_set = dataset(root      = args.img_root,
+						transform = train_transform,
+						train     = True,
+						download  = True)
+	if args.cuda and args.gpu_loader:
+		train_loader = GPUCifarLoader(train_set, batch_size=args.batch_size, shuffle=True)
+	else:
+		train_loader = torch.utils.data.DataLoader(
+				IndexedDataset(train_set),
+				batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True,
+				persistent_workers=True, prefetch_factor=4, collate_fn=fast_collate)
+
+	# teacher logits of every training sample, filled in the first epoch
+	if args.cuda and args.cache_teacher:
+		tcache = torch.empty(len(train_set), args.num_class, device='cuda', dtype=torch.float16)
+	else:
+		tcache = None
 	test_loader = torch.utils.data.DataLoader(
 			dataset(root      = args.img_root,
 					transform = test_transform,
 					train     = False,
 					download  = True),
-			batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True)
+			batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True,
+			persistent_workers=True, prefetch_factor=4, collate_fn=fast_collate)
+
+	# checkpoints are written by a background thread, one at a time
+	save_executor = ThreadPoolExecutor(max_workers=1)
+	save_future   = None
 
 	for epoch in range(1, args.epochs+1):
 		epoch_start_time = time.time()
 
-		adjust_lr(optimizer, epoch)
+		print('epoch: {}  lr: {}'.format(epoch, scheduler.get_last_lr()[0]))
 
 		# train one epoch
-		nets = {'snet':snet, 'tnet':tnet}
+		nets = {'snet':snet, 'tnet':tnet, 'tstream':tstream, 'normalizer':normalizer, 'tcache':tcache}
 		criterions = {'criterionCls':criterionCls}
 		train(train_loader, nets, optimizer, criterions, epoch)
+		scheduler.step()
+		if args.cuda:
+			torch.cuda.synchronize()
 		epoch_time = time.time() - epoch_start_time
 		print('one epoch time is {:02}h{:02}m{:02}s'.format(*transform_time(epoch_time)))
 
@@ -139,18 +194,25 @@ def main():
 		print('saving models......')
 		save_name = 'pkt_r{}_r{}_{:>03}.ckp'.format(args.t_name[6:], args.s_name[6:], epoch)
 		save_name = os.path.join(args.save_root, 'checkpoint', save_name)
+		if save_future is not None:
+			save_future.result()
+		# the frozen teacher is not saved again, only the path of its weights (--t_model)
 		if epoch == 1:
-			save_checkpoint({
+			save_future = save_checkpoint_async(save_executor, {
 				'epoch': epoch,
 				'snet': snet.state_dict(),
-				'tnet': tnet.state_dict(),
+				'tnet_path': args.t_model,
 			}, save_name)
 		else:
-			save_checkpoint({
+			save_future = save_checkpoint_async(save_executor, {
 				'epoch': epoch,
 				'snet': snet.state_dict(),
 			}, save_name)
 
+	save_executor.shutdown(wait=True)
+	if save_future is not None:
+		save_future.result()
+
 def train(train_loader, nets, optimizer, criterions, epoch):
 	batch_time = AverageMeter()
 	data_time  = AverageMeter()
@@ -159,44 +221,66 @@ def train(train_loader, nets, optimizer, criterions, epoch):
 	top1       = AverageMeter()
 	top5       = AverageMeter()
 
-	snet = nets['snet']
-	tnet = nets['tnet']
-
-	criterionCls    = criterions['criterionCls']
+	snet       = nets['snet']
+	normalizer = nets['normalizer']
 
 	snet.train()
 
+	# the graph is captured again every epoch, since lr and teacher caching are baked into it
+	use_graph    = args.cuda and args.cuda_graph
+	graph        = None
+	graph_warmup = 3
+	graph_stream = torch.cuda.Stream() if use_graph else None
+
 	end = time.time()
-	for idx, (img, target) in enumerate(train_loader, start=1):
+	for idx, (img, target, index) in enumerate(train_loader, start=1):
 		data_time.update(time.time() - end)
 
 		if args.cuda:
-			img = img.cuda()
-			target = target.cuda()
-
-		_, _, _, _, output_s = snet(img)
-		_, _, _, _, output_t = tnet(img)
-
-		cls_loss = criterionCls(output_s, target)
-		pkt_loss = pkt_cosine_similarity_loss(output_s, output_t.detach()) * args.lambda_pkt
-		loss = cls_loss + pkt_loss
-
+			img = img.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+			target = target.cuda(non_blocking=True)
+			index = index.cuda(non_blocking=True)
+		img = normalizer(img)
+
+		# cuda graphs need a static batch shape, so the last partial batch runs eagerly
+		# (it must not be skipped, the teacher cache would keep uninitialized rows)
+		if not use_graph or img.size(0) != args.batch_size:
+			output_s, cls_loss, pkt_loss = train_step(img, target, index, nets, optimizer, criterions, epoch)
+		elif idx <= graph_warmup:
+			graph_stream.wait_stream(torch.cuda.current_stream())
+			with torch.cuda.stream(graph_stream):
+				output_s, cls_loss, pkt_loss = train_step(img, target, index, nets, optimizer, criterions, epoch)
+			torch.cuda.current_stream().wait_stream(graph_stream)
+		else:
+			if graph is None:
+				static_inputs = [img.clone(), target.clone(), index.clone()]
+				optimizer.zero_grad(set_to_none=True)
+				graph = torch.cuda.CUDAGraph()
+				with torch.cuda.graph(graph):
+					static_outputs = train_step(*static_inputs, nets=nets, optimizer=optimizer,
+												criterions=criterions, epoch=epoch)
+			for static_input, x in zip(static_inputs, (img, target, index)):
+				static_input.copy_(x, non_blocking=True)
+			graph.replay()
+			output_s, cls_loss, pkt_loss = static_outputs
+
+		# meters accumulate device tensors, they are only synced when printed
 		prec1, prec5 = accuracy(output_s, target, topk=(1,5))
-		cls_losses.update(cls_loss.item(), img.size(0))
-		pkt_losses.update(pkt_loss.item(), img.size(0))
-		top1.update(prec1.item(), img.size(0))
-		top5.update(prec5.item(), img.size(0))
-
-		optimizer.zero_grad()
-		loss.backward()
-		optimizer.step()
-
+		cls_losses.update(cls_loss.detach(), img.size(0))
+		pkt_losses.update(pkt_loss.detach(), img.size(0))
+		top1.update(prec1, img.size(0))
+		top5.update(prec5, img.size(0))
+
+		# steps are only queued on the gpu, wait for them before timing a printed step,
+		# the running average is then the real step time while single values are not
+		if args.cuda and idx % args.print_freq == 0:
+			torch.cuda.synchronize()
 		batch_time.update(time.time() - end)
 		end = time.time()
 
 		if idx % args.print_freq == 0:
 			print('Epoch[{0}]:[{1:03}/{2:03}] '
-				  'Time:{batch_time.val:.4f} '
+				  'Time:{batch_time.avg:.4f} '
 				  'Data:{data_time.val:.4f}  '
 				  'Cls:{cls_losses.val:.4f}({cls_losses.avg:.4f})  '
 				  'PTK:{pkt_losses.val:.4f}({pkt_losses.avg:.4f})  '
@@ -205,6 +289,49 @@ def train(train_loader, nets, optimizer, criterions, epoch):
 				  epoch, idx, len(train_loader), batch_time=batch_time, data_time=data_time,
 				  cls_losses=cls_losses, pkt_losses=pkt_losses, top1=top1, top5=top5))
 
+def train_step(img, target, index, nets, optimizer, criterions, epoch):
+	snet    = nets['snet']
+	tnet    = nets['tnet']
+	tstream = nets['tstream']
+	tcache  = nets['tcache']
+
+	criterionCls    = criterions['criterionCls']
+
+	cached = tcache is not None and epoch > 1
+
+	# forward and losses run in bf16 on tensor cores, no grad scaler is needed for bf16
+	with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=bool(args.cuda),
+						cache_enabled=not args.cuda_graph):
+		# launch the teacher on its own stream, then the student on the default one
+		if cached:
+			output_t = tcache[index]
+		elif tstream is not None:
+			tstream.wait_stream(torch.cuda.current_stream())
+			with torch.cuda.stream(tstream):
+				with torch.inference_mode():
+					output_t = tnet(img, return_features=False)
+		else:
+			with torch.inference_mode():
+				output_t = tnet(img, return_features=False)
+
+		output_s = snet(img, return_features=False)
+
+		if tstream is not None and not cached:
+			torch.cuda.current_stream().wait_stream(tstream)
+			output_t.record_stream(torch.cuda.current_stream())
+		if tcache is not None and not cached:
+			tcache[index] = output_t.half()
+
+		cls_loss = criterionCls(output_s, target)
+		pkt_loss = pkt_cosine_similarity_loss(output_s, output_t.detach()) * args.lambda_pkt
+		loss = cls_loss + pkt_loss
+
+	optimizer.zero_grad(set_to_none=True)
+	loss.backward()
+	optimizer.step()
+
+	return output_s, cls_loss, pkt_loss
+
 def test(test_loader, nets, criterions):
 	cls_losses = AverageMeter()
 	pkt_losses = AverageMeter()
@@ -213,6 +340,7 @@ def test(test_loader, nets, criterions):
 
 	snet = nets['snet']
 	tnet = nets['tnet']
+	normalizer = nets['normalizer']
 
 	criterionCls    = criterions['criterionCls']
 
@@ -221,48 +349,36 @@ def test(test_loader, nets, criterions):
 	end = time.time()
 	for idx, (img, target) in enumerate(test_loader, start=1):
 		if args.cuda:
-			img = img.cuda()
-			target = target.cuda()
+			img = img.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+			target = target.cuda(non_blocking=True)
+		img = normalizer(img)
 
-		with torch.no_grad():
-			_, _, _, _, output_s = snet(img)
-			_, _, _, _, output_t = tnet(img)
+		with torch.inference_mode():
+			output_s = snet(img, return_features=False)
+			output_t = tnet(img, return_features=False)
 
 		cls_loss = criterionCls(output_s, target)
 		pkt_loss = pkt_cosine_similarity_loss(output_s, output_t.detach()) * args.lambda_pkt
 
 		prec1, prec5 = accuracy(output_s, target, topk=(1,5))
-		cls_losses.update(cls_loss.item(), img.size(0))
-		pkt_losses.update(pkt_loss.item(), img.size(0))
-		top1.update(prec1.item(), img.size(0))
-		top5.update(prec5.item(), img.size(0))
+		cls_losses.update(cls_loss.detach(), img.size(0))
+		pkt_losses.update(pkt_loss.detach(), img.size(0))
+		top1.update(prec1, img.size(0))
+		top5.update(prec5, img.size(0))
 
 	f_l = [cls_losses.avg, pkt_losses.avg, top1.avg, top5.avg]
 	print('Cls: {:.4f}, PTK: {:.4f}, Prec@1: {:.2f}, Prec@5: {:.2f}'.format(*f_l))
 
-def adjust_lr(optimizer, epoch):
-	scale   = 0.1
-	lr_list =  [args.lr] * 100
-	lr_list += [args.lr*scale] * 50
-	lr_list += [args.lr*scale*scale] * 50
-
-	lr = lr_list[epoch-1]
-	print('epoch: {}  lr: {}'.format(epoch, lr))
-	for param_group in optimizer.param_groups:
-		param_group['lr'] = lr
-
 '''
 Adopted from https://github.com/passalis/probabilistic_kt/blob/master/nn/pkt.py
+The whole loss is compiled into a single graph, so that inductor can fuse the
+element-wise ops around the two matmuls instead of launching one kernel each.
 '''
+@torch.compile(fullgraph=True, dynamic=True)
 def pkt_cosine_similarity_loss(output_s, output_t, eps=1e-5):
-	# Normalize each vector by its norm
-	output_s_norm = torch.sqrt(torch.sum(output_s ** 2, dim=1, keepdim=True))
-	output_s = output_s / (output_s_norm + eps)
-	output_s[output_s != output_s] = 0
-
-	output_t_norm = torch.sqrt(torch.sum(output_t ** 2, dim=1, keepdim=True))
-	output_t = output_t / (output_t_norm + eps)
-	output_t[output_t != output_t] = 0
+	# Normalize each vector by its norm, eps keeps zero vectors at zero instead of NaN
+	output_s = F.normalize(output_s, p=2, dim=1, eps=eps)
+	output_t = F.normalize(output_t, p=2, dim=1, eps=eps)
 
 	# Calculate the cosine similarity
 	output_s_cos_sim = torch.mm(output_s, output_s.transpose(0, 1))
@@ -276,8 +392,11 @@ def pkt_cosine_similarity_loss(output_s, output_t, eps=1e-5):
 	output_s_cond_prob = output_s_cos_sim / torch.sum(output_s_cos_sim, dim=1, keepdim=True)
 	output_t_cond_prob = output_t_cos_sim / torch.sum(output_t_cos_sim, dim=1, keepdim=True)
 
-	# Calculate the KL-divergence
-	loss = torch.mean(output_t_cond_prob * torch.log((output_t_cond_prob + eps) / (output_s_cond_prob + eps)))
+	# Calculate the KL-divergence in fp32
+	output_s_cond_prob = output_s_cond_prob.float()
+	output_t_cond_prob = output_t_cond_prob.float()
+	# mean over all BxB entries as before, not batchmean, so lambda_pkt keeps its scale
+	loss = F.kl_div(output_s_cond_prob.clamp_min(eps).log(), output_t_cond_prob, reduction='sum') / output_t_cond_prob.numel()
 
 	return loss
 
@@ -1,5 +1,7 @@
 from __future__ import print_function
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 class AverageMeter(object):
@@ -18,6 +20,89 @@ class AverageMeter(object):
 		self.count += n
 		self.avg   = self.sum / self.count
 
+class Normalizer(nn.Module):
+	"""Normalizes a batch of [0,255] images on its own device"""
+	def __init__(self, mean, std):
+		super(Normalizer, self).__init__()
+		self.register_buffer('mean', torch.tensor(mean).view(1, 3, 1, 1) * 255)
+		self.register_buffer('std', torch.tensor(std).view(1, 3, 1, 1) * 255)
+
+	def forward(self, x):
+		return x.float().sub(self.mean).div_(self.std)
+
+class IndexedDataset(torch.utils.data.Dataset):
+	"""Wraps a dataset so that every sample also returns its index"""
+	def __init__(self, dataset):
+		self.dataset = dataset
+
+	def __len__(self):
+		return len(self.dataset)
+
+	def __getitem__(self, index):
+		img, target = self.dataset[index]
+		return img, target, index
+
+def fast_collate(batch):
+	"""Copies uint8 images into one preallocated batch, the other fields become int64 tensors"""
+	shape = (len(batch),) + tuple(batch[0][0].shape)
+	if torch.utils.data.get_worker_info() is not None:
+		# workers hand the batch over through shared memory, allocate it there directly
+		# the same way default_collate does
+		elem    = torch.empty(0, dtype=torch.uint8)
+		storage = elem._typed_storage()._new_shared(int(np.prod(shape)), device=elem.device)
+		img     = elem.new(storage).resize_(shape)
+	else:
+		img = torch.empty(shape, dtype=torch.uint8)
+	for i, sample in enumerate(batch):
+		img[i].copy_(torch.as_tensor(sample[0]))
+	fields = [torch.tensor(field, dtype=torch.int64) for field in list(zip(*batch))[1:]]
+	return [img] + fields
+
+class GPUCifarLoader(object):
+	"""Keeps a whole CIFAR split on the GPU and does pad/crop/flip there, yields [0,255] float images and their indices"""
+	def __init__(self, dataset, batch_size, shuffle=True, augment=True, padding=4):
+		self.data       = torch.from_numpy(dataset.data).cuda().permute(0, 3, 1, 2).contiguous()
+		self.targets    = torch.tensor(dataset.targets, device='cuda')
+		self.batch_size = batch_size
+		self.shuffle    = shuffle
+		self.augment    = augment
+		self.padding    = padding
+
+	def __len__(self):
+		return (self.data.size(0) + self.batch_size - 1) // self.batch_size
+
+	def __iter__(self):
+		num = self.data.size(0)
+		if self.shuffle:
+			order = torch.randperm(num, device='cuda')
+		else:
+			order = torch.arange(num, device='cuda')
+
+		for start in range(0, num, self.batch_size):
+			index  = order[start:start+self.batch_size]
+			img    = self.data[index].float()
+			target = self.targets[index]
+			if self.augment:
+				img = self.random_crop_flip(img)
+			yield img, target, index
+
+	def random_crop_flip(self, img):
+		# reflect pad, then crop and flip every sample with a single gather
+		b, c, h, w = img.size()
+		p   = self.padding
+		img = F.pad(img, (p, p, p, p), mode='reflect')
+
+		off_y = torch.randint(0, 2*p+1, (b, 1), device=img.device)
+		off_x = torch.randint(0, 2*p+1, (b, 1), device=img.device)
+		rows  = off_y + torch.arange(h, device=img.device).view(1, h)
+		cols  = off_x + torch.arange(w, device=img.device).view(1, w)
+		flip  = torch.rand(b, 1, device=img.device) < 0.5
+		cols  = torch.where(flip, cols.flip(1), cols)
+
+		batch_idx   = torch.arange(b, device=img.device).view(b, 1, 1, 1)
+		channel_idx = torch.arange(c, device=img.device).view(1, c, 1, 1)
+		return img[batch_idx, channel_idx, rows.view(b, 1, h, 1), cols.view(b, 1, 1, w)]
+
 def print_network(net):
 	num_params = 0
 	for param in net.parameters():
@@ -45,17 +130,29 @@ def transform_time(s):
 def save_checkpoint(state, filename):
 	torch.save(state, filename)
 
+def state_to_cpu(state):
+	if torch.is_tensor(state):
+		return state.detach().to('cpu', copy=True)
+	if isinstance(state, dict):
+		out = type(state)((k, state_to_cpu(v)) for k, v in state.items())
+		# state_dict() keeps per-module versions here, load_state_dict needs them for upgrades
+		if hasattr(state, '_metadata'):
+			out._metadata = state._metadata
+		return out
+	return state
+
+def save_checkpoint_async(executor, state, filename):
+	"""Snapshots state to cpu, then saves it on the executor so that training can go on"""
+	return executor.submit(save_checkpoint, state_to_cpu(state), filename)
+
 def accuracy(output, target, topk=(1,)):
 	"""Computes the precision@k for the specified values of k"""
 	maxk = max(topk)
 	batch_size = target.size(0)
 
 	_, pred = output.topk(maxk, 1, True, True)
-	pred    = pred.t()
-	correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-	res = []
-	for k in topk:
-		correct_k = correct[:k].view(-1).float().sum(0)
-		res.append(correct_k.mul_(100.0 / batch_size))
-	return res
+	correct = pred.eq(target.view(-1, 1))
+
+	# hits at each rank, accumulated over ranks, give the top-k precisions for all k at once
+	correct_k = correct.float().sum(0).cumsum(0).mul_(100.0 / batch_size)
+	return [correct_k[k-1] for k in topk]